@@ -1,6 +1,7 @@
 """Test MediationManager."""
+import asyncio
 import logging
-from typing import AsyncIterable, Iterable
+from typing import AsyncIterable, Iterable, Tuple
 
 from asynctest import mock as async_mock
 import pytest
@@ -10,7 +11,10 @@ from .....core.event_bus import EventBus, MockEventBus
 from .....core.in_memory import InMemoryProfile
 from .....core.profile import Profile, ProfileSession
 from .....did.did_key import DIDKey
+from .....messaging.models.base_record import BaseRecord
+from .....storage.base import BaseStorage
 from .....storage.error import StorageNotFoundError
+from .....wallet.did_info import DIDInfo
 from ....routing.v1_0.models.route_record import RouteRecord
 from ..manager import (
     MediationAlreadyExists,
@@ -34,10 +38,26 @@ TEST_VERKEY = "did:key:z6Mkgg342Ycpuk263R9d8Aq6MUaxPn1DDeHyGo38EefXmgDL"
 TEST_ROUTE_RECORD_VERKEY = "9WCgWKUaAJj3VWxxtzvvMQN3AoFxoBtBDo9ntwJnVVCC"
 TEST_ROUTE_VERKEY = "did:key:z6MknxTj6Zj1VrDWc1ofaZtmCVv2zNXpD58Xup4ijDGoQhya"
 
+TEST_ADD_RULE = KeylistUpdateRule(
+    recipient_key=TEST_VERKEY, action=KeylistUpdateRule.RULE_ADD
+)
+TEST_REMOVE_RULE = KeylistUpdateRule(
+    recipient_key=TEST_VERKEY, action=KeylistUpdateRule.RULE_REMOVE
+)
+
+# The pinned pytest-asyncio (0.14) predates asyncio_mode = "auto"
 pytestmark = pytest.mark.asyncio
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
+def event_loop():
+    """Fixture for event loop shared by the module scoped async fixtures."""
+    loop = asyncio.get_event_loop_policy().new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module")
 def profile() -> Iterable[Profile]:
     """Fixture for profile used in tests."""
     # pylint: disable=W0621
@@ -51,20 +71,55 @@ def mock_event_bus(profile: Profile):
     yield profile.inject(EventBus)
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 async def session(profile) -> AsyncIterable[ProfileSession]:  # pylint: disable=W0621
     """Fixture for profile session used in tests."""
     async with profile.session() as session:
         yield session
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def manager(profile) -> Iterable[MediationManager]:  # pylint: disable=W0621
     """Fixture for manager used in tests."""
     yield MediationManager(profile)
 
 
+@pytest.fixture(scope="module")
+async def routing_did(session, manager) -> DIDInfo:  # pylint: disable=W0621
+    """Fixture for routing DID created once and shared by tests."""
+    # pylint: disable=W0212
+    return await manager._create_routing_did(session)
+
+
 @pytest.fixture
+async def prepared(
+    manager,  # pylint: disable=W0621
+) -> Tuple[MediationRecord, MediationRequest]:
+    """Fixture for mediation record and request prepared by manager."""
+    return await manager.prepare_request(TEST_CONN_ID)
+
+
+@pytest.fixture(autouse=True)
+async def clean_records(session):  # pylint: disable=W0621
+    """Fixture truncating records left behind by each test."""
+    yield
+    storage = session.inject(BaseStorage)
+    for record_type in (
+        RouteRecord.RECORD_TYPE,
+        MediationRecord.RECORD_TYPE,
+        MediationManager.DEFAULT_MEDIATOR_RECORD_TYPE,
+    ):
+        await storage.delete_all_records(record_type)
+
+
+@pytest.fixture
+def warning_log(caplog) -> Iterable[pytest.LogCaptureFixture]:
+    """Fixture for log capture at warning level."""
+    caplog.set_level(logging.WARNING)
+    yield caplog
+
+
+@pytest.fixture(scope="module")
 def record() -> Iterable[MediationRecord]:
     """Fixture for record used in tests."""
     yield MediationRecord(
@@ -72,6 +127,14 @@ def record() -> Iterable[MediationRecord]:
     )
 
 
+async def _bulk_save(session: ProfileSession, *records: BaseRecord):
+    """Save records through a single profile transaction."""
+    async with session.profile.transaction() as txn:
+        for record in records:
+            await record.save(txn)
+        await txn.commit()
+
+
 class TestMediationManager:  # pylint: disable=R0904,W0621
     """Test MediationManager."""
 
@@ -80,16 +143,20 @@ class TestMediationManager:  # pylint: disable=R0904,W0621
         with pytest.raises(MediationManagerError):
             MediationManager(None)
 
-    async def test_create_did(self, manager, session):
+    async def test_create_did(self, manager, session, routing_did):
         """test_create_did."""
         # pylint: disable=W0212
-        await manager._create_routing_did(session)
-        assert await manager._retrieve_routing_did(session)
+        retrieved = await manager._retrieve_routing_did(session)
+        assert retrieved.did == routing_did.did
+        assert retrieved.verkey == routing_did.verkey
 
-    async def test_retrieve_did_when_absent(self, manager, session):
+    async def test_retrieve_did_when_absent(self):
         """test_retrieve_did_when_absent."""
         # pylint: disable=W0212
-        assert await manager._retrieve_routing_did(session) is None
+        profile = InMemoryProfile.test_profile()
+        manager = MediationManager(profile)
+        async with profile.session() as session:
+            assert await manager._retrieve_routing_did(session) is None
 
     async def test_receive_request_no_terms(self, manager):
         """test_receive_request_no_terms."""
@@ -104,23 +171,32 @@ class TestMediationManager:  # pylint: disable=R0904,W0621
         with pytest.raises(MediationAlreadyExists):
             await manager.receive_request(TEST_CONN_ID, request)
 
-    @pytest.mark.skip(
-        reason="mediator and recipient terms are only loosely defined in RFC 0211"
-    )
-    async def test_receive_request_unacceptable_terms(self):
-        """test_receive_request_unacceptable_terms."""
-
-    async def test_grant_request(self, session, manager):
+    async def test_grant_request(self, session, manager, routing_did):
         """test_grant_request."""
-        # pylint: disable=W0212
         request = MediationRequest()
         record = await manager.receive_request(TEST_CONN_ID, request)
         assert record.connection_id == TEST_CONN_ID
         record, grant = await manager.grant_request(record.mediation_id)
         assert grant.endpoint == session.settings.get("default_endpoint")
-        routing_key = await manager._retrieve_routing_did(session)
         routing_key = DIDKey.from_public_key_b58(
-            routing_key.verkey, routing_key.key_type
+            routing_did.verkey, routing_did.key_type
+        ).did
+        assert grant.routing_keys == [routing_key]
+
+    async def test_grant_request_creates_routing_did(self):
+        """test_grant_request_creates_routing_did."""
+        # pylint: disable=W0212
+        profile = InMemoryProfile.test_profile(
+            bind={EventBus: MockEventBus(), DIDMethods: DIDMethods()}
+        )
+        manager = MediationManager(profile)
+        record = await manager.receive_request(TEST_CONN_ID, MediationRequest())
+        record, grant = await manager.grant_request(record.mediation_id)
+        async with profile.session() as session:
+            routing_did = await manager._retrieve_routing_did(session)
+        assert routing_did
+        routing_key = DIDKey.from_public_key_b58(
+            routing_did.verkey, routing_did.key_type
         ).did
         assert grant.routing_keys == [routing_key]
 
@@ -131,78 +207,51 @@ class TestMediationManager:  # pylint: disable=R0904,W0621
         assert record.connection_id == TEST_CONN_ID
         record, deny = await manager.deny_request(record.mediation_id)
 
-    async def test_update_keylist_delete(self, session, manager, record):
-        """test_update_keylist_delete."""
-        await RouteRecord(
-            connection_id=TEST_CONN_ID, recipient_key=TEST_RECORD_VERKEY
-        ).save(session)
-        response = await manager.update_keylist(
-            record=record,
-            updates=[
-                KeylistUpdateRule(
-                    recipient_key=TEST_VERKEY, action=KeylistUpdateRule.RULE_REMOVE
-                )
-            ],
-        )
-        results = response.updated
-        assert len(results) == 1
-        assert results[0].recipient_key == TEST_VERKEY
-        assert results[0].action == KeylistUpdateRule.RULE_REMOVE
-        assert results[0].result == KeylistUpdated.RESULT_SUCCESS
-
-    async def test_update_keylist_create(self, manager, record):
-        """test_update_keylist_create."""
+    @pytest.mark.parametrize(
+        "preexists,rule,expected",
+        [
+            (True, TEST_REMOVE_RULE, KeylistUpdated.RESULT_SUCCESS),
+            (False, TEST_ADD_RULE, KeylistUpdated.RESULT_SUCCESS),
+            (True, TEST_ADD_RULE, KeylistUpdated.RESULT_NO_CHANGE),
+        ],
+    )
+    async def test_update_keylist(
+        self, session, manager, record, preexists, rule, expected
+    ):
+        """test_update_keylist."""
+        if preexists:
+            await RouteRecord(
+                connection_id=TEST_CONN_ID, recipient_key=TEST_RECORD_VERKEY
+            ).save(session)
         response = await manager.update_keylist(
             record=record,
-            updates=[
-                KeylistUpdateRule(
-                    recipient_key=TEST_VERKEY, action=KeylistUpdateRule.RULE_ADD
-                )
-            ],
+            updates=[rule],
         )
         results = response.updated
         assert len(results) == 1
         assert results[0].recipient_key == TEST_VERKEY
-        assert results[0].action == KeylistUpdateRule.RULE_ADD
-        assert results[0].result == KeylistUpdated.RESULT_SUCCESS
+        assert results[0].action == rule.action
+        assert results[0].result == expected
 
-    async def test_update_keylist_create_existing(self, session, manager, record):
-        """test_update_keylist_create_existing."""
-        await RouteRecord(
-            connection_id=TEST_CONN_ID, recipient_key=TEST_RECORD_VERKEY
-        ).save(session)
-        response = await manager.update_keylist(
-            record=record,
-            updates=[
-                KeylistUpdateRule(
-                    recipient_key=TEST_VERKEY, action=KeylistUpdateRule.RULE_ADD
-                )
-            ],
+    async def test_update_keylist_x_not_granted(self, manager: MediationManager):
+        record = MediationRecord(
+            state=MediationRecord.STATE_DENIED, connection_id=TEST_CONN_ID
         )
-        results = response.updated
-        assert len(results) == 1
-        assert results[0].recipient_key == TEST_VERKEY
-        assert results[0].action == KeylistUpdateRule.RULE_ADD
-        assert results[0].result == KeylistUpdated.RESULT_NO_CHANGE
-
-    async def test_update_keylist_x_not_granted(
-        self, manager: MediationManager, record: MediationRecord
-    ):
-        record.state = MediationRecord.STATE_DENIED
         with pytest.raises(MediationNotGrantedError):
             await manager.update_keylist(record, [])
 
     async def test_get_keylist(self, session, manager, record):
         """test_get_keylist."""
-        await RouteRecord(connection_id=TEST_CONN_ID, recipient_key=TEST_VERKEY).save(
-            session
+        await _bulk_save(
+            session,
+            RouteRecord(connection_id=TEST_CONN_ID, recipient_key=TEST_VERKEY),
+            # Non-server route for verifying filtering
+            RouteRecord(
+                role=RouteRecord.ROLE_CLIENT,
+                connection_id=TEST_CONN_ID,
+                recipient_key=TEST_ROUTE_VERKEY,
+            ),
         )
-        # Non-server route for verifying filtering
-        await RouteRecord(
-            role=RouteRecord.ROLE_CLIENT,
-            connection_id=TEST_CONN_ID,
-            recipient_key=TEST_ROUTE_VERKEY,
-        ).save(session)
         results = await manager.get_keylist(record)
         assert len(results) == 1
         assert results[0].connection_id == TEST_CONN_ID
@@ -230,8 +279,10 @@ class TestMediationManager:  # pylint: disable=R0904,W0621
         self,
         session: ProfileSession,
         manager: MediationManager,
-        record: MediationRecord,
     ):
+        record = MediationRecord(
+            state=MediationRecord.STATE_GRANTED, connection_id=TEST_CONN_ID
+        )
         await record.save(session)
         assert await manager.get_default_mediator() is None
         await manager.set_default_mediator(record)
@@ -267,32 +318,28 @@ class TestMediationManager:  # pylint: disable=R0904,W0621
     ):
         await manager.clear_default_mediator()
 
-    async def test_prepare_request(self, manager):
+    async def test_prepare_request(self, prepared):
         """test_prepare_request."""
-        record, request = await manager.prepare_request(TEST_CONN_ID)
+        record, request = prepared
         assert record.connection_id == TEST_CONN_ID
         assert request
 
-    async def test_request_granted(self, manager):
+    async def test_request_granted(self, manager, prepared):
         """test_request_granted."""
-        record, _ = await manager.prepare_request(TEST_CONN_ID)
+        record, _ = prepared
         grant = MediationGrant(endpoint=TEST_ENDPOINT, routing_keys=[TEST_ROUTE_VERKEY])
         await manager.request_granted(record, grant)
         assert record.state == MediationRecord.STATE_GRANTED
         assert record.endpoint == TEST_ENDPOINT
         assert record.routing_keys == [TEST_ROUTE_RECORD_VERKEY]
 
-    async def test_request_denied(self, manager):
+    async def test_request_denied(self, manager, prepared):
         """test_request_denied."""
-        record, _ = await manager.prepare_request(TEST_CONN_ID)
+        record, _ = prepared
         deny = MediationDeny()
         await manager.request_denied(record, deny)
         assert record.state == MediationRecord.STATE_DENIED
 
-    @pytest.mark.skip(reason="Mediation terms are not well defined in RFC 0211")
-    async def test_request_denied_counter_terms(self):
-        """test_request_denied_counter_terms."""
-
     async def test_prepare_keylist_query(self, manager):
         """test_prepare_keylist_query."""
         query = await manager.prepare_keylist_query()
@@ -307,52 +354,45 @@ class TestMediationManager:  # pylint: disable=R0904,W0621
         assert query.paginate.limit == 10
         assert query.paginate.offset == 20
 
-    @pytest.mark.skip(reason="Filtering is not well defined in RFC 0211")
-    async def test_prepare_keylist_query_filter(self):
-        """test_prepare_keylist_query_filter."""
-
     async def test_add_key_no_message(self, manager):
         """test_add_key_no_message."""
         update = await manager.add_key(TEST_VERKEY)
         assert update.updates
         assert update.updates[0].action == KeylistUpdateRule.RULE_ADD
 
-    async def test_add_key_accumulate_in_message(self, manager):
-        """test_add_key_accumulate_in_message."""
-        update = await manager.add_key(TEST_VERKEY)
-        await manager.add_key(recipient_key=TEST_ROUTE_VERKEY, message=update)
-        assert update.updates
-        assert len(update.updates) == 2
-        assert update.updates[0].action == KeylistUpdateRule.RULE_ADD
-        assert update.updates[1].action == KeylistUpdateRule.RULE_ADD
-        assert update.updates[0].recipient_key == TEST_VERKEY
-        assert update.updates[1].recipient_key == TEST_ROUTE_VERKEY
-
     async def test_remove_key_no_message(self, manager):
         """test_remove_key_no_message."""
         update = await manager.remove_key(TEST_VERKEY)
         assert update.updates
         assert update.updates[0].action == KeylistUpdateRule.RULE_REMOVE
 
-    async def test_remove_key_accumulate_in_message(self, manager):
-        """test_remove_key_accumulate_in_message."""
-        update = await manager.remove_key(TEST_VERKEY)
-        await manager.remove_key(recipient_key=TEST_ROUTE_VERKEY, message=update)
-        assert update.updates
-        assert len(update.updates) == 2
-        assert update.updates[0].action == KeylistUpdateRule.RULE_REMOVE
-        assert update.updates[1].action == KeylistUpdateRule.RULE_REMOVE
-        assert update.updates[0].recipient_key == TEST_VERKEY
-        assert update.updates[1].recipient_key == TEST_ROUTE_VERKEY
-
-    async def test_add_remove_key_mix(self, manager):
-        """test_add_remove_key_mix."""
-        update = await manager.add_key(TEST_VERKEY)
-        await manager.remove_key(recipient_key=TEST_ROUTE_VERKEY, message=update)
+    @pytest.mark.parametrize(
+        "op1,op2,expected_actions",
+        [
+            (
+                "add_key",
+                "add_key",
+                [KeylistUpdateRule.RULE_ADD, KeylistUpdateRule.RULE_ADD],
+            ),
+            (
+                "remove_key",
+                "remove_key",
+                [KeylistUpdateRule.RULE_REMOVE, KeylistUpdateRule.RULE_REMOVE],
+            ),
+            (
+                "add_key",
+                "remove_key",
+                [KeylistUpdateRule.RULE_ADD, KeylistUpdateRule.RULE_REMOVE],
+            ),
+        ],
+    )
+    async def test_key_accumulate_in_message(self, manager, op1, op2, expected_actions):
+        """test_key_accumulate_in_message."""
+        update = await getattr(manager, op1)(TEST_VERKEY)
+        await getattr(manager, op2)(recipient_key=TEST_ROUTE_VERKEY, message=update)
         assert update.updates
         assert len(update.updates) == 2
-        assert update.updates[0].action == KeylistUpdateRule.RULE_ADD
-        assert update.updates[1].action == KeylistUpdateRule.RULE_REMOVE
+        assert [rule.action for rule in update.updates] == expected_actions
         assert update.updates[0].recipient_key == TEST_VERKEY
         assert update.updates[1].recipient_key == TEST_ROUTE_VERKEY
 
@@ -438,9 +478,8 @@ class TestMediationManager:  # pylint: disable=R0904,W0621
         assert route.wallet_id == "test_wallet"
         assert route.connection_id == TEST_CONN_ID
 
-    async def test_store_update_results_errors(self, caplog, manager):
+    async def test_store_update_results_errors(self, warning_log, manager):
         """test_store_update_results with errors."""
-        caplog.set_level(logging.WARNING)
         results = [
             KeylistUpdated(
                 recipient_key=TEST_VERKEY,
@@ -459,24 +498,28 @@ class TestMediationManager:  # pylint: disable=R0904,W0621
             ),
         ]
         await manager.store_update_results(TEST_CONN_ID, results)
-        assert "no_change" in caplog.text
-        assert "client_error" in caplog.text
-        assert "server_error" in caplog.text
-        print(caplog.text)
+        assert {
+            KeylistUpdated.RESULT_NO_CHANGE,
+            KeylistUpdated.RESULT_CLIENT_ERROR,
+            KeylistUpdated.RESULT_SERVER_ERROR,
+        } <= set(warning_log.text.split())
 
     async def test_get_my_keylist(self, session, manager):
         """test_get_my_keylist."""
-        await RouteRecord(
-            role=RouteRecord.ROLE_CLIENT,
-            connection_id=TEST_CONN_ID,
-            recipient_key=TEST_VERKEY,
-        ).save(session)
-        # Non-client record to verify filtering
-        await RouteRecord(
-            role=RouteRecord.ROLE_SERVER,
-            connection_id=TEST_CONN_ID,
-            recipient_key=TEST_ROUTE_VERKEY,
-        ).save(session)
+        await _bulk_save(
+            session,
+            RouteRecord(
+                role=RouteRecord.ROLE_CLIENT,
+                connection_id=TEST_CONN_ID,
+                recipient_key=TEST_VERKEY,
+            ),
+            # Non-client record to verify filtering
+            RouteRecord(
+                role=RouteRecord.ROLE_SERVER,
+                connection_id=TEST_CONN_ID,
+                recipient_key=TEST_ROUTE_VERKEY,
+            ),
+        )
         keylist = await manager.get_my_keylist(TEST_CONN_ID)
         assert keylist
         assert len(keylist) == 1